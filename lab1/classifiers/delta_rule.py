@@ -8,16 +8,18 @@ from helper import *
 
 class DeltaClassifier:
     """The delta learning classifier"""
-    def __init__(self, epochs=200, eta=0.001):
+    def __init__(self, epochs=200, eta=0.001, seed=None):
         """Class constructor
 
         Args:
             epochs (int): Number of training epochs
             eta (float): The learning rate
+            seed (int): Seed for shuffling the data in sequential training
         """
         self.epochs = epochs
         self.eta = eta
         self.W = np.random.rand(3, 1) # Initialize the weights
+        self.rng = np.random.default_rng(seed)
 
     def train(self, X, T, classA, classB, animate=False, batch=False, bias=True):
         """Train the classifier
@@ -40,24 +42,46 @@ class DeltaClassifier:
             self.W = self.W[:-1]
             X = X[:, :-1]
 
+        if not batch:
+            # Sequential training reshuffles private copies of the data every
+            # epoch, through scratch buffers owned by the classifier
+            X, T = np.array(X), np.array(T)
+            self._X_buf, self._T_buf = np.empty_like(X), np.empty_like(T)
+
+            # Pre-allocate the error and weight update of a single data point,
+            # so that the inner loop runs without allocations
+            err = np.empty(self.W.shape[1:])
+            dW = np.empty_like(self.W)
+
         for e in range(self.epochs):
             if batch:
                 dW = - self.eta * X.T @ (X@self.W - T) # Delta rule
                 self.W += dW # Update the weight vector
 
-                if abs(dW.sum()) < 10**-4:
+                # Compare the largest update rather than the sum, in which
+                # positive and negative components can cancel out
+                if np.abs(dW).max() < 10**-4:
                     print((f'The delta ruled converged after {e} epochs (i.e. '
-                        f'abs(dW.sum() < 10**-4).'))
+                        f'max(abs(dW)) < 10**-4).'))
                     break
             else:
-                dw = 0
+                X_prev, T_prev = X, T
+                X, T = shuffle_into(X_prev, T_prev, self.rng, self._X_buf,
+                        self._T_buf)
+
+                # The previous order becomes the scratch space of the next epoch
+                self._X_buf, self._T_buf = X_prev, T_prev
+
                 for i, (x, t) in enumerate(zip(X, T)):
-                    dW = - self.eta * x.T * (x@self.W - t)
-                    self.W += dW.reshape(3,1) # Update the weight vector
+                    np.matmul(x, self.W, out=err)
+                    err -= t
+                    err *= -self.eta
+                    np.multiply(x.reshape(-1, 1), err, out=dW)
+                    self.W += dW # Update the weight vector
 
-                    if abs(dW.sum()) < 10**-7:
+                    if np.abs(dW).max() < 10**-7:
                         print((f'The delta ruled converged after {e} epochs (i.e. '
-                               f'abs(dW.sum() < 10**-4) and {i} data points.'))
+                               f'max(abs(dW)) < 10**-7) and {i} data points.'))
                         break
                 else: # Makes sure that the outer loop breaks if the inner breaks
                     continue
@@ -8,6 +8,8 @@ __author__ = "Anton Anderzén, Stella Katsarou, Bas Straathof"
 
 
 import numpy as np
+from scipy.linalg.blas import get_blas_funcs
+from scipy.special import expit
 from helper import *
 
 
@@ -25,17 +27,17 @@ class SingleLayerPerceptron:
         self.W = np.random.rand(3, 1) # Initialize the weights
 
 
-    def predict(self, x, threshold=0):
+    def predict(self, X, threshold=0):
         """Perceptron prediction function
 
         Args:
-            x (np.ndarray): Data point to be predicted
+            X (np.ndarray): Data points to be predicted of shape (n, d)
             threshold (float): Threshold for perceptron activation function
 
         Returns:
-            activation (int): Perceptron output (0 or 1)
+            (np.ndarray): Perceptron outputs (-1 or 1) of shape (n, 1)
         """
-        return 1 if (x @ self.W >= 0) else -1.
+        return np.where(X @ self.W >= threshold, 1., -1.)
 
 
     def train(self, X, T, classA, classB, animate):
@@ -48,14 +50,10 @@ class SingleLayerPerceptron:
                             boundary on each epoch.
         """
         for e in range(self.epochs):
-            has_misclassification = False
-            for x, t in zip(X, T):
-                # t_pred must be of shape (1,)
-                t_pred = self.predict(x, t)
-                if t_pred != t:
-                    has_misclassification = True
-                # Reshape required for correct broadcasting
-                self.W += self.eta * (t[0] - t_pred) / 2 * (x).reshape(3,1)
+            # Predict all data points at once and update the weights in batch
+            T_pred = self.predict(X)
+            has_misclassification = np.any(T_pred != T)
+            self.W += self.eta / 2 * X.T @ (T - T_pred)
             if not has_misclassification:
                 print(f'The perceptron converged after {e} epochs.')
                 break
@@ -97,50 +95,87 @@ class TwoLayerPerceptron:
         # Number of data poitns and the dimensionality of data points
         n, d = X.shape[0], X.shape[1]
 
-        # Initialize the weights
-        self.V = np.random.normal(0, 1/np.sqrt(d), (d, self.h))
-        self.W = np.random.normal(0, 1/np.sqrt(self.h), (self.h, 1))
+        # Initialize the weights in single precision
+        self.V = np.random.normal(0, 1/np.sqrt(d), (d, self.h)).astype(
+                np.float32)
+        self.W = np.random.normal(0, 1/np.sqrt(self.h), (self.h, 1)).astype(
+                np.float32)
+
+        # Pre-allocate scratch buffers for the forward pass on the training data
+        self._h_buf = np.empty((n, self.h), dtype=np.float32)
+        self._o_buf = np.empty((n, 1), dtype=np.float32)
+
+        # Pre-allocate the activation derivatives, the output delta and the
+        # momentum weight updates
+        self._d_h_buf = np.empty((n, self.h), dtype=np.float32)
+        self._d_o_buf = np.empty((n, 1), dtype=np.float32)
+        self._delta_o_buf = np.empty((n, 1), dtype=np.float32)
+        self._dV = np.zeros(self.V.shape, dtype=np.float32)
+        self._dW = np.zeros(self.W.shape, dtype=np.float32)
 
 
     @staticmethod
-    def _activation_function(x):
+    def _activation_function(x, out=None):
         """Computes the non-linear activation function
 
         Args:
-            x {float or np.ndarray}: Input to be transformed
+            x (np.ndarray): Input to be transformed
+            out (np.ndarray): Optional buffer to write the output into, which
+                              may be x itself
 
         Returns:
-            (float or np.ndarray): Output
+            (np.ndarray): Output
         """
-        return 2 / (1 + np.exp(-x)) - 1
+        # 2 / (1 + exp(-x)) - 1, computed in place in a single buffer
+        out = expit(x, out=out)
+        out *= 2
+        out -= 1
+
+        return out
 
 
     @staticmethod
-    def _d_activation_function(x):
+    def _d_activation_function(x, out=None):
         """Computes the derivative of the non-linear activation function
 
         Args:
-            x {float or np.ndarray}: Input transformed by non-linear activation
+            x (np.ndarray): Input transformed by non-linear activation
+            out (np.ndarray): Optional buffer to write the output into
 
         Returns:
-            (float or np.ndarray): Output
+            (np.ndarray): Output
 
         """
-        return np.multiply((1+ x), (1-x)) / 2
+        # (1 + x)(1 - x) / 2 = (1 - x^2) / 2, computed in a single buffer
+        out = np.square(x, out=out)
+        np.subtract(1, out, out=out)
+        out *= 0.5
+
+        return out
 
 
-    def forward_pass(self, X):
+    def forward_pass(self, X, use_buffers=False):
         """ Forward pass of the baackprop algorithm
 
         Args:
             X (np.ndarray): The input data
+            use_buffers (bool): Whether to write into the scratch buffers that
+                                are allocated for the training data. The
+                                returned arrays are then overwritten by the
+                                next buffered forward pass.
 
         Returns:
             h (np.ndarray): Output of the hidden layer
             o (np.ndarray): Final output
         """
-        h = self._activation_function(X @ self.V)
-        o = self._activation_function(h @ self.W)
+        if use_buffers:
+            h = np.matmul(X, self.V, out=self._h_buf)
+            self._activation_function(h, out=h)
+            o = np.matmul(h, self.W, out=self._o_buf)
+            self._activation_function(o, out=o)
+        else:
+            h = self._activation_function(X @ self.V)
+            o = self._activation_function(h @ self.W)
 
         return h, o
 
@@ -153,26 +188,23 @@ class TwoLayerPerceptron:
             threshold (float): Classification threshold
 
         Returns:
-            X (np.ndarray): Matrix of predictions corresponding to X
+            (np.ndarray): Matrix of predictions corresponding to X
         """
-        X[X >= threshold] = 1
-        X[X < threshold] = -1
+        return np.where(X >= threshold, 1, -1)
 
-        return X
 
-
-    def compute_accuracy(self, X, t):
+    def compute_accuracy(self, o, t):
         """Calculate training/testing accuracy
 
         Args:
-            X (np.ndarray): Observations of shape (n, d)
+            o (np.ndarray): Output of the forward pass of shape (n, 1)
             t (np.ndarray): Targets of shape (n, 1)
 
         Returns:
            (float): The accuracy
         """
         # Make a prediction based on the perceptron's output
-        p = self.predict(self.forward_pass(X)[1])
+        p = self.predict(o)
 
         return 1 - np.mean(p != t)
 
@@ -195,30 +227,45 @@ class TwoLayerPerceptron:
         # Initialize weights based on dimensions of observations and targets
         self.initialize_weights(X, t)
 
+        # The weight updates are accumulated in place by BLAS gemm, which needs
+        # the observations in the same dtype as the weights
+        X = np.ascontiguousarray(X, dtype=self.V.dtype)
+        gemm = get_blas_funcs('gemm', (X,))
+        dV, dW, delta_o = self._dV, self._dW, self._delta_o_buf
+
         for e in range(self.epochs):
             # Forward pass
-            h, o = self.forward_pass(X)
+            h, o = self.forward_pass(X, use_buffers=True)
 
             # Backward pass
-            delta_o = np.multiply((o - t), self._d_activation_function(o))
-            delta_h = np.multiply(delta_o @ self.W.T,
-                    self._d_activation_function(h))
-
+            np.subtract(o, t, out=delta_o)
+            delta_o *= self._d_activation_function(o, out=self._d_o_buf)
+            delta_h = np.einsum('nk,hk,nh->nh', delta_o, self.W,
+                    self._d_activation_function(h, out=self._d_h_buf))
+
+            # dV = alpha * dV + (1-alpha) * X^T delta_h, and likewise for dW,
+            # written straight into the momentum buffers. The transposed
+            # products keep every operand Fortran-ordered, so BLAS makes no
+            # copies
             if e == 0:
-                dV = X.T @ delta_h
-                dW = h.T @ delta_o
+                grad_scale, momentum = 1., 0.
             else:
-                dV = alpha * dV + (1-alpha) * X.T @ delta_h
-                dW = alpha * dW + (1-alpha) * h.T @ delta_o
+                grad_scale, momentum = 1-alpha, alpha
+            gemm(grad_scale, delta_h.T, X.T, momentum, dV.T, trans_b=True,
+                    overwrite_c=True)
+            gemm(grad_scale, delta_o.T, h.T, momentum, dW.T, trans_b=True,
+                    overwrite_c=True)
 
             # Update the weights
-            self.V += - self.eta * dV
-            self.W += - self.eta * dW
+            self.V -= self.eta * dV
+            self.W -= self.eta * dW
 
-            # Compute the accuracy
-            acc = self.compute_accuracy(X, t)
+            # Compute the accuracy, reusing the output of this epoch's forward
+            # pass on the training data
+            acc = self.compute_accuracy(o, t)
             self.train_acc.append(acc)
-            acc = self.compute_accuracy(X_validation, t_validation)
+            acc = self.compute_accuracy(self.forward_pass(X_validation)[1],
+                    t_validation)
             self.validation_acc.append(acc)
             if print_acc:
                 print(f'The training accuracy after epoch {e}: {acc}')
@@ -6,10 +6,9 @@ __author__ = "Anton Anderzén, Stella Katsarou, Bas Straathof"
 
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.utils import shuffle
 
 
-def generate_data(n, mA, sigmaA, mB, sigmaB, special_case=False):
+def generate_data(n, mA, sigmaA, mB, sigmaB, special_case=False, seed=None):
     """Generates toy data
 
     Args:
@@ -20,6 +19,7 @@ def generate_data(n, mA, sigmaA, mB, sigmaB, special_case=False):
         sigmaB (float): Variance of classB
         special_case (bool): Flag to specify the special case of non-linearly
                              separable data at 3.1.3
+        seed (int): Seed for the random number generator
 
     Returns:
         classA (np.ndarray): Data points belonging to classA
@@ -28,18 +28,15 @@ def generate_data(n, mA, sigmaA, mB, sigmaB, special_case=False):
     Note: a row in the lab description is a column in the code here, and vice
     versa. This simplifies shuffling, and doesn't have any adverse side-effects.
     """
-    classA, classB = np.zeros((n, 2)), np.zeros((n, 2))
+    rng = np.random.default_rng(seed)
 
-    if special_case:
-        classA[:, 0] = np.hstack((np.random.randn(1, round(0.5*n))
-            * sigmaA - mA[0], np.random.randn(1, round(0.5*n))
-            * sigmaA + mA[0]))
-    else:
-        classA[:, 0] = np.random.randn(1, n) * sigmaA + mA[0]
+    # Draw both coordinates of each class in a single call
+    classA = rng.standard_normal((n, 2)) * sigmaA + np.asarray(mA)
+    classB = rng.standard_normal((n, 2)) * sigmaB + np.asarray(mB)
 
-    classA[:, 1] = np.random.randn(1, n) * sigmaA + mA[1]
-    classB[:, 0] = np.random.randn(1, n) * sigmaB + mB[0]
-    classB[:, 1] = np.random.randn(1, n) * sigmaB + mB[1]
+    if special_case:
+        # The first half of classA is centered around -mA[0] instead
+        classA[:round(0.5*n), 0] -= 2 * mA[0]
 
     return classA, classB
 
@@ -76,28 +73,53 @@ def create_training_examples_and_targets(classA, classB):
         classB (np.ndarray): Data points belonging to classB
 
     Returns:
-        X (np.ndarray): Training data including bias term
-        t (np.ndarray): Target vector
+        X (np.ndarray): Training data including bias term (float32)
+        t (np.ndarray): Target vector (float32)
 
     """
     # Get number of data points per class
     n = classA.shape[0]
     m = classB.shape[0]
 
-    # Add an bias row to the matrices representing the two different classes
-    classA = np.hstack((classA, np.ones((n, 1))))
-    classB = np.hstack((classB, np.ones((m, 1))))
-
-    # Store the training data in a big matrix
-    X = np.vstack((classA, classB))
+    # Store the training data in one big matrix with a bias column
+    X = np.empty((n+m, 3), dtype=np.float32)
+    X[:n, :2] = classA
+    X[n:, :2] = classB
+    X[:, 2] = 1
 
     # Create a targets vector where classA = -1 and classB = 1
-    t = np.vstack((np.ones((n, 1))*-1, np.ones((m, 1))))
+    t = np.empty((n+m, 1), dtype=np.float32)
+    t[:n] = -1
+    t[n:] = 1
 
     # Shuffle the training data and targets in a consistent manner
-    X, t = shuffle(X, t, random_state=0)
+    perm = np.random.RandomState(0).permutation(n+m)
 
-    return X, t
+    return X[perm], t[perm]
+
+
+def shuffle_into(X, t, rng, X_out, t_out):
+    """Shuffles training data and targets into output buffers in a consistent
+    manner
+
+    Args:
+        X (np.ndarray): Training data to be shuffled
+        t (np.ndarray): Target vector to be shuffled
+        rng (np.random.Generator): Random number generator
+        X_out (np.ndarray): Buffer of the same shape and dtype as X
+        t_out (np.ndarray): Buffer of the same shape and dtype as t
+
+    Returns:
+        X_out (np.ndarray): The shuffled training data
+        t_out (np.ndarray): The shuffled targets
+    """
+    # Gather the permuted rows straight into the buffers, so that only the
+    # permutation index is allocated
+    idx = rng.permutation(X.shape[0])
+    np.take(X, idx, axis=0, out=X_out)
+    np.take(t, idx, axis=0, out=t_out)
+
+    return X_out, t_out
 
 
 def create_data_scatter_plot(classA, classB, linearly_separable=False, fname="",
@@ -191,11 +213,13 @@ def approx_decision_boundary_animation(classA_train, classB_train,
     plt.xlabel("x1"), plt.ylabel("x2")
     res = np.linspace(-2, 2, 1000)
     xlist, ylist = np.meshgrid(res, res)
-    grid_data = np.vstack((np.ravel(xlist), np.ravel(ylist)))
-    grid_data = np.vstack((grid_data, np.ones((1, len(grid_data[0])))))
-    grid_data = np.transpose(grid_data)
-    Z = net.predict(net.forward_pass(grid_data)[1])
-    Z = np.reshape(Z, (len(xlist), len(xlist[0])))
+
+    # Build the grid with its bias column directly in C-contiguous (N, 3) form
+    grid_data = np.empty((res.size*res.size, 3), dtype=np.float32)
+    grid_data[:, 0] = xlist.ravel()
+    grid_data[:, 1] = ylist.ravel()
+    grid_data[:, 2] = 1
+    Z = net.predict(net.forward_pass(grid_data)[1]).reshape(res.size, res.size)
     plt.contour(res, res, Z, [0], color='black')
     plt.scatter(classA_train[:, 0], classA_train[:, 1], color='red')
     plt.scatter(classB_train[:, 0], classB_train[:, 1], color='green')
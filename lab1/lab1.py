@@ -30,14 +30,15 @@ BIAS = True
 # Generate toy-data
 if LINEARLY_SEPARABLE_DATA:
     classA, classB = generate_data(n=100, mA=[1.0, 1.0], sigmaA=0.4,
-            mB=[-1.0, -0.5], sigmaB=0.4)
+            mB=[-1.0, -0.5], sigmaB=0.4, seed=42)
 
 elif LINEARLY_UNSEPARABLE_DATA_3_1_3:
-    classA, classB = generate_data(100, [1.0, 0.3], 0.2, [0.0, -0.1], 0.3, special_case=True)
+    classA, classB = generate_data(100, [1.0, 0.3], 0.2, [0.0, -0.1], 0.3, special_case=True,
+            seed=42)
 
 else:
     classA, classB = generate_data(n=100, mA=[.5, .5], sigmaA=0.5,
-            mB=[-.5, -0.5], sigmaB=0.5)
+            mB=[-.5, -0.5], sigmaB=0.5, seed=42)
 
 if SUBSAMPLE:
     classA_train, classB_train, classA_validation, classB_validation, = subsample_data(classA, classB, 25, 25)
@@ -61,7 +62,7 @@ if APPLY_DELTA_RULE_BATCH:
                 bias=False)
 
 if APPLY_DELTA_RULE_SEQUENTIAL:
-    delta_learning = DeltaClassifier()
+    delta_learning = DeltaClassifier(seed=42)
     delta_learning.train(X, t, classA, classB, animate=True)
 
 if APPLY_PERCEPTRON_LEARNING_RULE:
@@ -5,6 +5,77 @@
 __author__ = "Anton Anderzén, Stella Katsarou, Bas Straathof"
 
 import numpy as np
+from numba import njit, prange, get_num_threads
+
+
+@njit(parallel=True, fastmath=True)
+def _residuals(Phi, f, w, err):
+    """Computes the residuals f - Phi w and the total approximation error
+
+    Args:
+        Phi (np.ndarray): RBFs on the input (N, n)
+        f (np.ndarray): Vector of target function values (N,)
+        w (np.ndarray): Weight vector (n,)
+        err (np.ndarray): Output buffer for the residuals (N,)
+
+    Returns:
+        (float): The total approximation error, as in
+                 RBFNN.compute_total_error
+    """
+    N, n = Phi.shape
+    total = 0.0
+    for i in prange(N):
+        f_hat = 0.0
+        for j in range(n):
+            f_hat += Phi[i, j] * w[j]
+        err[i] = f[i] - f_hat
+        total += abs(f_hat) - abs(f[i])
+
+    return abs(total / N)
+
+
+@njit(parallel=True, fastmath=True)
+def _delta_epochs(Phi, f, w, eta, epochs, tol):
+    """Runs the batch delta rule epochs of RBFNN.train in place on w
+
+    Args:
+        Phi (np.ndarray): RBFs on the input (N, n)
+        f (np.ndarray): Vector of target function values (N,)
+        w (np.ndarray): Weight vector (n,), updated in place
+        eta (float): The learning rate
+        epochs (int): The maximum number of epochs
+        tol (float): Stop once the error decreases by less than this
+
+    Returns:
+        e (int): The last epoch that was run
+        error (float): The total approximation error after that epoch
+        converged (bool): Whether the stopping criterion was met
+    """
+    N, n = Phi.shape
+    n_chunks = get_num_threads()
+    err = np.empty(N)
+    partial = np.empty((n_chunks, n))
+
+    error_old = _residuals(Phi, f, w, err)
+    error = error_old
+    for e in range(epochs):
+        # Each thread accumulates Phi^T err over its own chunk of the data
+        for c in prange(n_chunks):
+            partial[c, :] = 0.0
+            for i in range(c * N // n_chunks, (c+1) * N // n_chunks):
+                for j in range(n):
+                    partial[c, j] += Phi[i, j] * err[i]
+
+        for j in range(n):
+            w[j] += eta * partial[:, j].sum()
+
+        error = _residuals(Phi, f, w, err)
+        if error_old - error < tol:
+            return e, error, True
+
+        error_old = error
+
+    return epochs - 1, error, False
 
 
 class RBFNN:
@@ -37,27 +108,12 @@ class RBFNN:
         if solver=="delta_rule":
             self.epochs = epochs
             # Initialize the weight matrix
-            self.w = np.random.normal(0, 1, self.n).reshape(self.n, 1)
+            self.w = np.random.normal(0, 1, self.n).reshape(self.n, 1).astype(
+                    np.float32)
         else:
             self.w = None
 
 
-    @staticmethod
-    def _gaussian_activation(x, h):
-        """Computes the Gaussian transfer function
-
-        Args:
-            x {float or np.ndarray}: Input to be transformed
-            h (np.ndarray): Array of two floats:
-                mu_h (float): The mean of the hidden input unit
-                sigma_h (float): The variance of the hidden input unit
-
-        Returns:
-            (float or np.ndarray): Output
-        """
-        return np.exp(-1 * (x - h[0])**2 / (2*h[1]))
-
-
     def initialize_hidden_nodes(self, x_range, variance):
         """Initialzie the hidden units
 
@@ -65,15 +121,19 @@ class RBFNN:
             x_range (tuple): Range for the sampling of x values
             variance (float): The variance of the hidden units
 
-        Sets self.H:
-            self.H (np.ndarray): Array of means and variance of the hidden nodes
+        Sets self.centers, self.variances and self._inv_two_var:
+            self.centers (np.ndarray): Means of the hidden nodes (n,)
+            self.variances (np.ndarray): Variances of the hidden nodes (n,)
+            self._inv_two_var (np.ndarray): 1 / (2*variance) per hidden node
         """
-        # Pre-allocate the array containing the hidden nodes means and variances
-        self.H = np.zeros((self.n, 2))
-        self.H[:, 1] = variance
-        for i in range(self.n):
-            # Sample a mean from a uniform distribution
-            self.H[i][0] = np.random.uniform(x_range[0], x_range[1])
+        # Keep the means and variances in separate contiguous float32 arrays,
+        # and sample the means from a uniform distribution
+        self.centers = np.random.uniform(x_range[0], x_range[1],
+                self.n).astype(np.float32)
+        self.variances = np.full(self.n, variance, dtype=np.float32)
+
+        # Hoist the division out of the Gaussian activation
+        self._inv_two_var = 1 / (2*self.variances)
 
 
     def competitive_learning(self, X):
@@ -82,18 +142,26 @@ class RBFNN:
         Args:
             X (np.ndarray): Input data
 
-        Updates self.H based on CL
+        Updates self.centers based on CL
         """
-        for i in range(self.cl_iterations):
-            x = np.random.choice(X)
-            winner = np.argmin(abs(abs(x) - abs(self.H[:, 0])))
+        if self.cl_strat not in (1, 2):
+            raise ValueError('cl_strat has to be one of 1, 2')
+
+        # Draw all training samples at once and keep the absolute values of
+        # the centers around, refreshing only the winner after each update
+        xs = np.random.choice(X, size=self.cl_iterations)
+        abs_centers = abs(self.centers)
+
+        for x in xs:
+            winner = np.argmin(abs(abs(x) - abs_centers))
 
             if self.cl_strat == 1:
-                self.H[winner] += self.eta * x
-            elif self.cl_strat == 2:
-                self.H[winner] += self.eta * (abs(x) - abs(self.H[winner][0]))
+                self.centers[winner] += self.eta * x
             else:
-                raise ValueError('cl_strat has to be one of 1, 2')
+                self.centers[winner] += self.eta * (abs(x) -
+                        abs_centers[winner])
+
+            abs_centers[winner] = abs(self.centers[winner])
 
 
     def compute_phi(self, X):
@@ -105,12 +173,10 @@ class RBFNN:
         Returns:
             Phi (np.ndarray): RBFs on the input (N, n)
         """
-        Phi = np.zeros((len(X), self.n))
-        for i, x in enumerate(X):
-            for j, h in enumerate(self.H):
-                Phi[i][j] = self._gaussian_activation(x, h)
+        # Broadcast the (N, 1) inputs against the (n,) hidden unit means
+        diff = np.asarray(X, dtype=np.float32).reshape(-1, 1) - self.centers
 
-        return Phi
+        return np.exp(-diff*diff * self._inv_two_var)
 
 
     def train(self, X, f, variance):
@@ -123,7 +189,8 @@ class RBFNN:
 
         Sets self.PHi and self.w, where self.w (np.ndarray): Weight vector (n, 1)
         """
-        # self.H (np.ndarray): mean and variance of hidden units (n, 2)
+        # self.centers, self.variances (np.ndarray): hidden unit means and
+        # variances (n,)
         self.initialize_hidden_nodes((min(X), max(X)), variance)
 
         if self.cl:
@@ -131,37 +198,31 @@ class RBFNN:
 
         # Phi (np.ndarray): RBFs on the input (N, n)
         Phi = self.compute_phi(X)
+        self.Phi = Phi
 
         # Solve the weights with least squares batch learning
         if self.solver=="least_squares":
             f = f.reshape(f.shape[0], 1)
 
-            self.w = np.matmul(np.matmul(np.linalg.inv(np.matmul(Phi.T, Phi)), Phi.T), f)
+            # Solve Phi w = f directly instead of forming inv(Phi^T Phi). The
+            # solve runs in float64 to preserve conditioning
+            w, *_ = np.linalg.lstsq(Phi.astype(np.float64), f, rcond=None)
+            self.w = w.astype(np.float32)
 
-        # Solve the weights sequentially using the delta rule
+        # Solve the weights in batch using the delta rule
         elif self.solver=="delta_rule":
-            f_pred = self.predict(X)
-            error_old = self.compute_total_error(f, f_pred)
-            for e in range(self.epochs):
-                for x, phi, f_x in zip(X, Phi, f):
-                    f_x_hat = self.compute_f_x_hat(phi)
-
-                    dw = self.eta * (f_x - f_x_hat) * phi.reshape(phi.shape[0], 1)
-                    self.w += dw
-
-                # Perhaps we could create a validation set and compute the total
-                # error on this set to devise some kind of stopping criterion
-                f_pred = self.predict(X)
-                error = self.compute_total_error(f, f_pred)
-
-
-                if error_old - error < 10**-2:
-                    print(f'The delta rule converged after {e} epochs')
-                    print(f'The total MSE on the training set is: {error}')
-                    break
-
-                error_old = error
-
+            f = np.ascontiguousarray(f, dtype=np.float32).reshape(-1)
+
+            # The summed delta rule update over each epoch runs in a compiled
+            # kernel that updates self.w in place
+            # Perhaps we could create a validation set and compute the total
+            # error on this set to devise some kind of stopping criterion
+            e, error, converged = _delta_epochs(Phi, f, self.w.reshape(-1),
+                    self.eta, self.epochs, 10**-2)
+
+            if converged:
+                print(f'The delta rule converged after {e} epochs')
+                print(f'The total MSE on the training set is: {error}')
 
 
     def compute_f_x_hat(self, phi_k):
@@ -14,6 +14,9 @@ __author__ = "Anton Anderzén, Stella Katsarou, Bas Straathof"
 
 from util import *
 from rbm import RestrictedBoltzmannMachine as RBM
+from concurrent.futures import ThreadPoolExecutor
+from threadpoolctl import threadpool_limits
+import os
 
 
 class DeepBeliefNetTwoLayer():
@@ -26,7 +29,7 @@ class DeepBeliefNetTwoLayer():
     hid : hidden
     vis : visible"""
 
-    def __init__(self, sizes, image_size, n_labels, batch_size):
+    def __init__(self, sizes, image_size, n_labels, batch_size, seed=None):
         """Class Constructior
 
         Args:
@@ -34,6 +37,7 @@ class DeepBeliefNetTwoLayer():
             image_size (list): Image dimension of data
             n_labels (int): Number of label categories
             batch_size (int): Size of mini-batch
+            seed (int): Seed for the random numbers of the Gibbs samplers
         """
 
         self.rbm_stack = {
@@ -53,9 +57,10 @@ class DeepBeliefNetTwoLayer():
         self.n_gibbs_wakesleep = 5
         self.n_labels = n_labels
         self.reconstruction_errors = []
+        self.rng = np.random.default_rng(seed)
 
 
-    def recognize(self, X, y):
+    def recognize(self, X, y, n_workers=None):
         """Recognize/Classify the data into label categories and calc accuracy
 
         Args:
@@ -64,27 +69,60 @@ class DeepBeliefNetTwoLayer():
           y (np.ndarray): true labels of shape (number of samples,
                           size of label layer). Used only for calculating
                           accuracy, not driving the net
+          n_workers (int): Number of threads that each classify a chunk of the
+                           data, defaults to the number of CPUs
         """
-        y_init = np.ones(y.shape) * 0.1 # Uninformed labels
+        n_workers = min(n_workers or os.cpu_count(), X.shape[0])
+
+        # Independent streams for the workers, seeded from self.rng so that
+        # every call draws new ones (Generator.spawn needs numpy >= 1.25)
+        rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(
+                self.rng.integers(2**63)).spawn(n_workers)]
+
+        # BLAS releases the GIL, so the chunks are sampled concurrently. Each
+        # worker gets its share of the BLAS threads to avoid oversubscription
+        with threadpool_limits(limits=max(1, os.cpu_count() // n_workers),
+                user_api="blas"), ThreadPoolExecutor(n_workers) as pool:
+            y_pred = np.vstack(list(pool.map(self._recognize_chunk,
+                np.array_split(X, n_workers), rngs)))
+
+        print ("accuracy = %.2f%%" % (100. * np.mean(np.argmax(
+            y_pred, axis=1) == np.argmax(y, axis=1))))
+
+
+    def _recognize_chunk(self, X, rng):
+        """Classify a chunk of the data by alternating Gibbs sampling in the top
+        RBM, with the labels starting out uninformed
+
+        Args:
+          X (np.ndarray): visible data of shape (size of chunk,
+                          size of visible layer)
+          rng (np.random.Generator): Random number generator of this chunk
+
+        Returns:
+          y_pred (np.ndarray): Sampled one-hot labels of shape (size of chunk,
+                               size of label layer)
+        """
+        # Uninformed labels
+        y_init = np.full((X.shape[0], self.n_labels), 0.1, dtype=np.float32)
 
         # Specify the RBMS
         vis__hid = self.rbm_stack["vis--hid"]
         hid_lbl__top = self.rbm_stack["hid+lbl--top"]
 
         # Forward propagation through the network
-        h_prob, h_state = vis__hid.get_h_given_v(X, directed=True,
-                direction="up")
+        h_prob = vis__hid.get_h_prob_given_v(X)
 
         # Perform alternating Gibbs sampling
         v_prob = np.hstack((h_prob, y_init))
+        n_h, n_v = hid_lbl__top.ndim_hidden, hid_lbl__top.ndim_visible
         for _ in range(self.n_gibbs_recog):
-            h_prob, h_state = hid_lbl__top.get_h_given_v(v_prob)
-            v_prob, v_state = hid_lbl__top.get_v_given_h(h_state)
-
-        y_pred = v_state[:, -10:]
+            # One draw covers the uniform random numbers of a full Gibbs step
+            u = rng.random((X.shape[0], n_h + n_v), dtype=np.float32)
+            h_prob, h_state = hid_lbl__top.get_h_given_v(v_prob, u=u[:, :n_h])
+            v_prob, v_state = hid_lbl__top.get_v_given_h(h_state, u=u[:, n_h:])
 
-        print ("accuracy = %.2f%%" % (100. * np.mean(np.argmax(
-            y_pred, axis=1) == np.argmax(y, axis=1))))
+        return v_state[:, -self.n_labels:]
 
 
     def generate(self, X, y, name):
@@ -95,10 +133,9 @@ class DeepBeliefNetTwoLayer():
           y (np.ndarray): True label
           name (str): For saving a video of generated visible activations
         """
-        n_sample, records = y.shape[0], []
-        fig, ax = plt.subplots(1, 1, figsize=(3, 3))
-        plt.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
-        ax.set_xticks([]); ax.set_yticks([])
+        # Every 10th Gibbs step is recorded as a frame of the video
+        frames = np.empty((len(range(0, self.n_gibbs_gener, 10)),
+            *self.image_size), dtype=np.float32)
 
         # Specify the RBMs
         vis__hid = self.rbm_stack["vis--hid"]
@@ -110,10 +147,17 @@ class DeepBeliefNetTwoLayer():
 
         v_state = np.hstack((h_state.reshape(1, -1), y))
 
+        # Draw the uniform random numbers of the whole Gibbs chain at once
+        n_h, n_v = hid_lbl__top.ndim_hidden, hid_lbl__top.ndim_visible
+        U = self.rng.random((self.n_gibbs_gener, y.shape[0], n_h + n_v),
+                dtype=np.float32)
+
         # Perform Gibbs sampling
         for it in range(self.n_gibbs_gener):
-            h_prob, h_state = hid_lbl__top.get_h_given_v(v_state)
-            v_prob, v_state = hid_lbl__top.get_v_given_h(h_state)
+            h_prob, h_state = hid_lbl__top.get_h_given_v(v_state,
+                    u=U[it, :, :n_h])
+            v_prob, v_state = hid_lbl__top.get_v_given_h(h_state,
+                    u=U[it, :, n_h:])
             v_state[:, -10:] = y # Fix y
 
             if it % 10 == 0:
@@ -123,12 +167,11 @@ class DeepBeliefNetTwoLayer():
                 h_prob, h_state = vis__hid.get_v_given_h(v_state_data_only,
                         directed=True, direction="down")
 
-                records.append([ax.imshow(np.mean(h_prob, axis=0).reshape(
-                    self.image_size), cmap="bwr", vmin=0, vmax=1, animated=True,
-                    interpolation=None)])
+                frames[it // 10] = np.mean(h_prob, axis=0).reshape(
+                        self.image_size)
 
-            anim = stitch_video(fig,records).save(
-                "plots_and_animations/%s.generate%d.mp4" % (name,np.argmax(y)))
+        save_video(frames, "plots_and_animations/%s.generate%d.mp4" % (name,
+            np.argmax(y)))
 
 
     def train_greedylayerwise(self, X, y, n_iterations, load_from_file=False,
@@ -174,20 +217,27 @@ class DeepBeliefNetTwoLayer():
             # Untwine the weights after learning
             self.rbm_stack["vis--hid"].untwine_weights()
 
+            # Propagate the training set once through the frozen layer, straight
+            # into the data part of the training set of the top layer
+            hid_lbl = np.empty((X.shape[0], self.sizes["hid"] +
+                    self.sizes["lbl"]), dtype=np.float32)
+            self.rbm_stack["vis--hid"].get_h_prob_given_v(X,
+                    out=hid_lbl[:, :-self.n_labels])
+            hid_lbl[:, -self.n_labels:] = y
+
 
             ## RBM HID+LBL--TOP
             print ("\n>> Training layer hid+lbl--top...")
 
             # Learn the weights of the hid+lbl--top RBM by means of CD1
             if compute_rec_err:
-                err = self.rbm_stack["hid+lbl--top"].cd1(np.hstack(
-                    (self.rbm_stack["vis--hid"].H, y)), n_iterations=n_iterations,
+                err = self.rbm_stack["hid+lbl--top"].cd1(hid_lbl,
+                    n_iterations=n_iterations,
                     compute_rec_err=compute_rec_err)
                 self.reconstruction_errors.append(err)
             else:
-                self.rbm_stack["hid+lbl--top"].cd1(np.hstack(
-                    (self.rbm_stack["vis--hid"].H, y)),
-                    n_iterations=n_iterations)
+                self.rbm_stack["hid+lbl--top"].cd1(hid_lbl,
+                        n_iterations=n_iterations)
 
             # Save layer represenetations to file if requested
             if save_to_file: self.savetofile_rbm(loc="trained_rbm_2l",
@@ -227,6 +277,11 @@ class DeepBeliefNetTwoLayer():
             vis__hid.learning_rate = 1e-5
             hid_lbl__top.learning_rate = 1e-5
 
+            # The label part of the input of the top RBM never changes
+            v_lbl = np.empty((X.shape[0], hid_lbl__top.ndim_visible),
+                    dtype=np.float32)
+            v_lbl[:, -self.n_labels:] = y
+
             for it in range(n_iterations):
                 ## Wake-phase
                 # RBM vis__hid
@@ -240,11 +295,13 @@ class DeepBeliefNetTwoLayer():
                 v = h
 
                 # Training the top RBM with CD1
-                hid_lbl__top.cd1(np.hstack((v, y)), X.shape[0])
+                v_lbl[:, :-self.n_labels] = v
+                hid_lbl__top.cd1(v_lbl, X.shape[0])
 
                 ## Alternating Gibbs sampling in the top RBM
                 for _ in range(self.n_gibbs_wakesleep):
-                    ph, h = hid_lbl__top.get_h_given_v(np.hstack((v, y)))
+                    v_lbl[:, :-self.n_labels] = v
+                    ph, h = hid_lbl__top.get_h_given_v(v_lbl)
                     pv, v = hid_lbl__top.get_v_given_h(h)
                     v = v[:, :-10]
 
@@ -270,12 +327,11 @@ class DeepBeliefNetTwoLayer():
             loc (str): The location of the file
             name (str): Name of RBM
         """
-        self.rbm_stack[name].weight_vh = np.load(f"{loc}/rbm.{name}.weight_vh.npy",
-                allow_pickle=True)
-        self.rbm_stack[name].bias_v = np.load(f"{loc}/rbm.{name}.bias_v.npy",
-                allow_pickle=True)
-        self.rbm_stack[name].bias_h = np.load(f"{loc}/rbm.{name}.bias_h.npy",
-                allow_pickle=True)
+        # Parameters are kept in single precision, whatever was saved
+        with np.load(f"{loc}/rbm.{name}.npz") as params:
+            for key in ("weight_vh", "bias_v", "bias_h"):
+                setattr(self.rbm_stack[name], key,
+                        params[key].astype(np.float32, copy=False))
         print(f"Loaded rbm[{name}] from {loc}.")
 
 
@@ -286,9 +342,10 @@ class DeepBeliefNetTwoLayer():
             loc (str): The location of the file
             name (str): Name of RBM
         """
-        np.save(f"{loc}/rbm.{name}.weight_vh", self.rbm_stack[name].weight_vh)
-        np.save(f"{loc}/rbm.{name}.bias_v", self.rbm_stack[name].bias_v)
-        np.save(f"{loc}/rbm.{name}.bias_h", self.rbm_stack[name].bias_h)
+        np.savez(f"{loc}/rbm.{name}.npz",
+                weight_vh=self.rbm_stack[name].weight_vh,
+                bias_v=self.rbm_stack[name].bias_v,
+                bias_h=self.rbm_stack[name].bias_h)
 
 
     def loadfromfile_dbn(self, loc, name):
@@ -298,13 +355,11 @@ class DeepBeliefNetTwoLayer():
             loc (str): The location of the file
             name (str): Name of RBM
         """
-        self.rbm_stack[name].weight_v_to_h = \
-                np.load(f"{loc}/dbn.{name}.weight_v_to_h.npy", allow_pickle=True)
-        self.rbm_stack[name].weight_h_to_v = \
-                np.load(f"{loc}/dbn.{name}.weight_h_to_v.npy", allow_pickle=True)
-        self.rbm_stack[name].bias_v = np.load(f"{loc}/dbn.{name}.bias_v.npy",
-                allow_pickle=True)
-        self.rbm_stack[name].bias_h = np.load(f"{loc}/dbn.{name}.bias_h.npy")
+        # Parameters are kept in single precision, whatever was saved
+        with np.load(f"{loc}/dbn.{name}.npz") as params:
+            for key in ("weight_v_to_h", "weight_h_to_v", "bias_v", "bias_h"):
+                setattr(self.rbm_stack[name], key,
+                        params[key].astype(np.float32, copy=False))
         print(f"Loaded rbm[{name}] from {loc}.")
 
 
@@ -315,10 +370,9 @@ class DeepBeliefNetTwoLayer():
             loc (str): The location of the file
             name (str): Name of RBM
         """
-        np.save(f"{loc}/dbn.{name}.weight_v_to_h",
-                self.rbm_stack[name].weight_v_to_h)
-        np.save(f"{loc}/dbn.{name}.weight_h_to_v",
-                self.rbm_stack[name].weight_h_to_v)
-        np.save(f"{loc}/dbn.{name}.bias_v", self.rbm_stack[name].bias_v)
-        np.save(f"{loc}/dbn.{name}.bias_h", self.rbm_stack[name].bias_h)
+        np.savez(f"{loc}/dbn.{name}.npz",
+                weight_v_to_h=self.rbm_stack[name].weight_v_to_h,
+                weight_h_to_v=self.rbm_stack[name].weight_h_to_v,
+                bias_v=self.rbm_stack[name].bias_v,
+                bias_h=self.rbm_stack[name].bias_h)
 
@@ -12,8 +12,194 @@ __author__ = "Anton Anderzén, Stella Katsarou, Bas Straathof"
 
 
 from util import *
+import math
 import numpy as np
 import time
+from numba import njit, prange, types
+from numba.extending import overload
+
+
+# Coefficients of the clamped rational approximation of tanh(t) = t * P(t^2) /
+# Q(t^2), which is accurate to float32 rounding
+_TANH_CLAMP = np.float32(7.90531110763549805)
+_TANH_P = tuple(np.float32(c) for c in (4.89352455891786e-03,
+    6.37261928875436e-04, 1.48572235717979e-05, 5.12229709037114e-08,
+    -8.60467152213735e-11, 2.00018790482477e-13, -2.76076847742355e-16))
+_TANH_Q = tuple(np.float32(c) for c in (4.89352518554385e-03,
+    2.26843463243900e-03, 1.18534705686654e-04, 1.19825839466702e-06))
+
+
+def _sigmoid(x):
+    """Logistic sigmoid of a scalar, for use inside the compiled kernels
+
+    Args:
+        x (float): Support of a unit
+
+    Returns:
+        (float): Probability to turn the unit ON
+    """
+    return 1. / (1. + math.exp(-max(x, -700.)))
+
+
+@overload(_sigmoid, fastmath=True, inline="always")
+def _sigmoid_overload(x):
+    """Specializes _sigmoid at compile time. Single precision uses
+    sigmoid(x) = (1 + tanh(x/2)) / 2 with the rational tanh, which avoids
+    the call to exp; double precision keeps the exact formula
+
+    The single precision error is a few float32 ulps near 0.5 (spacing
+    6e-8), i.e. around 2e-7 depending on the CPU's fused multiply-adds, and
+    the far tails may round to exactly 0 or 1
+    """
+    if isinstance(x, types.Float) and x.bitwidth == 32:
+        p0, p1, p2, p3, p4, p5, p6 = _TANH_P
+        q0, q1, q2, q3 = _TANH_Q
+        half, clamp = np.float32(0.5), _TANH_CLAMP
+
+        def fast_sigmoid(x):
+            t = min(max(half * x, -clamp), clamp)
+            t2 = t * t
+            p = p0 + t2*(p1 + t2*(p2 + t2*(p3 + t2*(p4 + t2*(p5 + t2*p6)))))
+            q = q0 + t2*(q1 + t2*(q2 + t2*q3))
+            return half + half * (t * p / q)
+
+        return fast_sigmoid
+
+    return _sigmoid
+
+
+@njit(nogil=True, fastmath=True)
+def _sigmoid_sample_kernel(support, u, prob, state):
+    """Computes sigmoid probabilities and samples binary states in one pass.
+    Runs without the GIL, so chunks of data can be processed from threads
+
+    Args:
+        support (np.ndarray): (size of mini-batch, size of layer)
+        u (np.ndarray): Uniform random numbers of the same shape as support
+        prob (np.ndarray): Output buffer for the on_probabilities
+        state (np.ndarray): Output buffer for the activations
+    """
+    for i in range(support.shape[0]):
+        for j in range(support.shape[1]):
+            p = _sigmoid(support[i, j])
+            prob[i, j] = p
+            state[i, j] = 1. if p >= u[i, j] else 0.
+
+
+@njit(nogil=True, fastmath=True)
+def _sigmoid_kernel(support):
+    """Computes sigmoid probabilities in place, without the GIL
+
+    Args:
+        support (np.ndarray): (size of mini-batch, size of layer)
+    """
+    for i in range(support.shape[0]):
+        for j in range(support.shape[1]):
+            support[i, j] = _sigmoid(support[i, j])
+
+
+@njit(parallel=True, fastmath=True)
+def _momentum_step(param, d_param, grad, learning_rate, momentum, decay):
+    """Applies a momentum update to a parameter in place, in a single pass:
+    d_param = momentum * d_param + (1 - momentum) * lr * (grad - decay * param)
+    and param += d_param
+
+    Args:
+        param (np.ndarray): Contiguous parameter array
+        d_param (np.ndarray): Contiguous momentum term of the same shape
+        grad (np.ndarray): Contiguous gradient of the same shape
+        learning_rate (float)
+        momentum (float)
+        decay (float)
+    """
+    p, d, g = param.reshape(-1), d_param.reshape(-1), grad.reshape(-1)
+    scale = (1 - momentum) * learning_rate
+    for i in prange(p.shape[0]):
+        d[i] = momentum * d[i] + scale * (g[i] - decay * p[i])
+        p[i] += d[i]
+
+
+@njit(parallel=True, fastmath=True)
+def _cd1_step_kernel(v0, weight, bias_v, bias_h, d_weight, d_bias_v, d_bias_h,
+        u, n_labels, learning_rate, momentum, decay, h0_prob, h0_state,
+        v1_prob, v1_state, h1_prob, v_stack, h_stack, dW):
+    """Runs one step of CD-1 on a mini-batch and updates the parameters in place
+
+    The matrix products go to BLAS, while the activation, sampling and update
+    loops are fused around them.
+
+    Args:
+        v0 (np.ndarray): Mini-batch of data (size of mini-batch, ndim_visible)
+        weight, bias_v, bias_h (np.ndarray): Parameters, updated in place
+        d_weight, d_bias_v, d_bias_h (np.ndarray): Momentum terms, updated in
+                                                   place
+        u (np.ndarray): Uniform random numbers of shape
+                        (size of mini-batch, ndim_hidden + ndim_visible)
+        n_labels (int): Number of softmax label units at the end of the
+                        visible layer, 0 if there are none
+        learning_rate, momentum, decay (float)
+        h0_prob, h0_state, v1_prob, v1_state, h1_prob (np.ndarray): Output
+                                buffers for the units of the Gibbs chain
+        v_stack, h_stack, dW (np.ndarray): Scratch buffers for the gradient
+    """
+    b, n_h = h0_prob.shape
+    n_v = v1_prob.shape[1]
+    n_data = n_v - n_labels
+
+    # Activate and sample hidden units based on the mini-batch data
+    np.dot(v0, weight, h0_prob)
+    for i in prange(b):
+        for j in range(n_h):
+            p = _sigmoid(h0_prob[i, j] + bias_h[j])
+            h0_prob[i, j] = p
+            h0_state[i, j] = 1. if p >= u[i, j] else 0.
+
+    # Activate and sample visible units based on the hidden state
+    np.dot(h0_state, weight.T, v1_prob)
+    for i in prange(b):
+        for j in range(n_data):
+            p = _sigmoid(v1_prob[i, j] + bias_v[j])
+            v1_prob[i, j] = p
+            v1_state[i, j] = 1. if p >= u[i, n_h + j] else 0.
+
+        if n_labels > 0:
+            # Softmax over the labels, sampled with a single random number
+            top = v1_prob[i, n_data] + bias_v[n_data]
+            for j in range(n_data, n_v):
+                top = max(top, v1_prob[i, j] + bias_v[j])
+            total = 0.
+            for j in range(n_data, n_v):
+                v1_prob[i, j] = math.exp(v1_prob[i, j] + bias_v[j] - top)
+                total += v1_prob[i, j]
+
+            pick, cumsum = n_data, 0.
+            for j in range(n_data, n_v):
+                v1_prob[i, j] /= total
+                cumsum += v1_prob[i, j]
+                v1_state[i, j] = 0.
+                if cumsum < u[i, n_h + n_data]:
+                    pick = min(j + 1, n_v - 1)
+            v1_state[i, pick] = 1.
+
+    # The hidden probabilities based on the generated visible state suffice
+    np.dot(v1_state, weight, h1_prob)
+    for i in prange(b):
+        for j in range(n_h):
+            h1_prob[i, j] = _sigmoid(h1_prob[i, j] + bias_h[j])
+
+    # Compute v0^T h0 - v1^T h1 as a single matrix product, as update_params
+    v_stack[:b] = v0
+    v_stack[b:] = -v1_prob
+    h_stack[:b] = h0_prob
+    h_stack[b:] = h1_prob
+    np.dot(v_stack.T, h_stack, dW)
+
+    grad_v = (v0 - v1_prob).sum(axis=0) / b
+    grad_h = (h0_prob - h1_prob).sum(axis=0) / b
+
+    _momentum_step(weight, d_weight, dW, learning_rate, momentum, decay)
+    _momentum_step(bias_v, d_bias_v, grad_v, learning_rate, momentum, 0.)
+    _momentum_step(bias_h, d_bias_h, grad_h, learning_rate, momentum, 0.)
 
 
 class RestrictedBoltzmannMachine():
@@ -45,30 +231,44 @@ class RestrictedBoltzmannMachine():
         self.batch_size = batch_size
         self.n_labels = n_labels
 
+        # All parameters are stored in single precision
+
         # Initialize W ~ N(0, 0.01) (R^v, R^h)
         self.weight_vh = np.random.normal(loc=0.0, scale=0.01,
-                size=(self.ndim_visible,self.ndim_hidden))
+                size=(self.ndim_visible,self.ndim_hidden)).astype(np.float32)
 
         # Initialize bias_v ~ N(0, 01) (R^v)
         self.bias_v = np.random.normal(loc=0.0, scale=0.01,
-                size=(self.ndim_visible))
+                size=(self.ndim_visible)).astype(np.float32)
 
         # Initialize bias_h ~ N(0, 01) (R^h)
         self.bias_h = np.random.normal(loc=0.0, scale=0.01,
-                size=(self.ndim_hidden))
-
-        self.d_weight_vh = np.zeros((self.ndim_visible, self.ndim_hidden))
-        self.d_weight_v_to_h = np.zeros(self.d_weight_vh.shape)
-        self.d_weight_h_to_v = np.zeros(self.d_weight_vh.shape).T
-        self.d_bias_v = np.zeros((self.ndim_visible))
-        self.d_bias_h = np.zeros((self.ndim_hidden))
+                size=(self.ndim_hidden)).astype(np.float32)
+
+        self.d_weight_vh = np.zeros((self.ndim_visible, self.ndim_hidden),
+                dtype=np.float32)
+        self.d_weight_v_to_h = np.zeros(self.d_weight_vh.shape, dtype=np.float32)
+        self.d_weight_h_to_v = np.zeros(self.d_weight_vh.shape,
+                dtype=np.float32).T
+        self.d_bias_v = np.zeros((self.ndim_visible), dtype=np.float32)
+        self.d_bias_h = np.zeros((self.ndim_hidden), dtype=np.float32)
         self.momentum = 0
         self.decay = 0
         self.learning_rate = learning_rate
         self.image_size = image_size
 
-        # In DBNs we sometimes want to return the hidden layer
-        self.H = None
+        # Scratch buffers that are reused across all CD-1 iterations
+        B, dtype = self.batch_size, self.weight_vh.dtype
+        self._buf = {
+            "h_pos_prob": np.empty((B, self.ndim_hidden), dtype=dtype),
+            "h_pos_state": np.empty((B, self.ndim_hidden), dtype=dtype),
+            "v_neg_prob": np.empty((B, self.ndim_visible), dtype=dtype),
+            "v_neg_state": np.empty((B, self.ndim_visible), dtype=dtype),
+            "h_neg_prob": np.empty((B, self.ndim_hidden), dtype=dtype),
+            "v_stack": np.empty((2*B, self.ndim_visible), dtype=dtype),
+            "h_stack": np.empty((2*B, self.ndim_hidden), dtype=dtype),
+            "dW": np.empty((self.ndim_visible, self.ndim_hidden), dtype=dtype)
+        }
 
         # Receptive-fields, only applicable when visible layer is input data
         self.rf = {
@@ -80,63 +280,98 @@ class RestrictedBoltzmannMachine():
 
 
     @staticmethod
-    def _sigmoid(support):
-        """ Sigmoid activation function that finds probabilities to turn ON each unit
+    def _sigmoid_sample(support, prob=None, state=None, u=None):
+        """Sigmoid activation function that finds probabilities to turn ON each
+        unit, fused with sampling the activations ON=1 (OFF=0) from them
 
         Args:
             support (np.ndarray): (size of mini-batch, size of layer)
+            prob (np.ndarray): Optional output buffer for the probabilities
+            state (np.ndarray): Optional output buffer for the activations
+            u (np.ndarray): Optional uniform random numbers for the sampling
 
         Returns:
-            (np.ndarray): on_probabilities (size of mini-batch, size of layer)
+            prob (np.ndarray): on_probabilities (size of mini-batch, size of layer)
+            state (np.ndarray): activations (size of mini-batch, size of layer)
         """
-        support[support < -700] = -700
-        return 1. / (1. + np.exp(-support))
+        if prob is None: prob = np.empty(support.shape, dtype=support.dtype)
+        if state is None: state = np.empty(support.shape, dtype=support.dtype)
+        if u is None: u = np.random.random_sample(size=support.shape)
+
+        # The kernel works on 2D views, so that single data points also work
+        n = support.shape[-1]
+        _sigmoid_sample_kernel(support.reshape(-1, n), u.reshape(-1, n),
+                prob.reshape(-1, n), state.reshape(-1, n))
+
+        return prob, state
+
+
+    def _batch_buffers(self, n, *names):
+        """Get views of the first n rows of the named scratch buffers
+
+        Args:
+            n (int): Size of the mini-batch
+            names (str): Keys of self._buf
+
+        Returns:
+            (tuple): The buffer views, in the order of names
+        """
+        return tuple(self._buf[name][:n] for name in names)
 
 
     @staticmethod
-    def _softmax(support):
-        """Softmax activation function that finds probabilities of each category
+    def _support(x, weight, bias, out=None):
+        """Compute the support bias + x @ weight of a layer
 
         Args:
-            support (np.ndarray): (size of mini-batch, number of categories)
+            x (np.ndarray): Units of the input layer
+            weight (np.ndarray): Weight matrix from the input layer
+            bias (np.ndarray): Bias of the output layer
+            out (np.ndarray): Optional output buffer
 
         Returns:
-            (np.ndarray): on_probabilities (size of mini-batch, number of categories)
+            (np.ndarray): The support of the output layer
         """
-        expsup = np.exp(support - np.max(support, axis=1)[:,None])
+        if out is None:
+            return bias + x@weight
 
-        return expsup / expsup.sum(axis=1)[:, None]
+        np.matmul(x, weight, out=out)
+        out += bias
+
+        return out
 
 
     @staticmethod
-    def _sample_binary(on_probabilities):
-        """Sample activations ON=1 (OFF=0) from probabilities sigmoid probabilities
+    def _softmax(support):
+        """Softmax activation function that finds probabilities of each category
 
         Args:
-            on_probabilities: (np.ndarray): activation probabilities
-                              shape=(size of mini-batch, size of layer)
+            support (np.ndarray): (size of mini-batch, number of categories)
 
         Returns:
-            (np.ndarray): activations (size of mini-batch, size of layer)
+            (np.ndarray): on_probabilities (size of mini-batch, number of categories)
         """
-        return 1. * (on_probabilities >= np.random.random_sample(
-            size=on_probabilities.shape))
+        expsup = np.exp(support - np.max(support, axis=1)[:,None])
+
+        return expsup / expsup.sum(axis=1)[:, None]
 
 
     @staticmethod
-    def _sample_categorical(probabilities):
+    def _sample_categorical(probabilities, u=None):
         """Sample one-hot activations from categorical probabilities
 
         Args:
             probabilities (np.ndarray): activation probabilities shape of
                                         (size of mini-batch, number of categories)
+            u (np.ndarray): Optional uniform random numbers, one per data point
 
         Returns:
             activations (np.ndarray): one hot encoded argmax probability
                                       (size of mini-batch, number of categories)
         """
         cumsum = np.cumsum(probabilities, axis=1)
-        rand = np.random.random_sample(size=probabilities.shape[0])[:, None]
+        if u is None: u = np.random.random_sample(size=probabilities.shape[0])
+        rand = u.reshape(-1, 1)
         activations = np.zeros(probabilities.shape)
         activations[range(probabilities.shape[0]),
                 np.argmax((cumsum >= rand), axis=1)] = 1
@@ -167,8 +402,12 @@ class RestrictedBoltzmannMachine():
 
         print(f'\n> Learning CD1 for {n_epochs} epochs...')
 
-        # We want to regenerate the complete visual and hidden layers
-        V, self.H = np.zeros(X.shape), np.zeros((n_samples, self.ndim_hidden))
+        # The compiled CD-1 step needs data in the precision of the weights
+        X = np.ascontiguousarray(X, dtype=self.weight_vh.dtype)
+        n_labels = self.n_labels if self.is_top else 0
+
+        # We want to regenerate the complete visual layer
+        V = np.zeros(X.shape, dtype=np.float32)
 
         if compute_rec_err:
             errors = []
@@ -182,25 +421,20 @@ class RestrictedBoltzmannMachine():
             # Create a data batch
             X_batch = X[mb_start:mb_end]
 
-            # Activate and sample hidden units based on mini-batch data
-            ph_prob, ph_state = self.get_h_given_v(X_batch)
-
-            # Activate and sample visible units based on hidden state
-            v_prob, v_state = self.get_v_given_h(ph_state)
+            # Sample the Gibbs chain and update the parameters in one call
+            b = X_batch.shape[0]
+            u = np.random.random_sample(size=(b,
+                self.ndim_hidden + self.ndim_visible))
+            buffers = self._batch_buffers(b, "h_pos_prob", "h_pos_state",
+                    "v_neg_prob", "v_neg_state", "h_neg_prob")
+            _cd1_step_kernel(X_batch, self.weight_vh, self.bias_v, self.bias_h,
+                    self.d_weight_vh, self.d_bias_v, self.d_bias_h, u, n_labels,
+                    self.learning_rate, self.momentum, self.decay, *buffers,
+                    *self._batch_buffers(2*b, "v_stack", "h_stack"),
+                    self._buf["dW"])
 
             # Combine to reconstruct the full data matrix
-            V[mb_start:mb_end, :] = v_prob
-
-            # Activate and sample hidden units again, based on generated visible
-            # state
-            nh_prob, _ = self.get_h_given_v(v_state)
-
-            # Reconstruct the complete hidden layer only during the last epoch
-            if epoch == n_epochs-1:
-               self.H[mb_start:mb_end, :] = nh_prob
-
-            # Updating parameters
-            self.update_params(X_batch, ph_prob, v_prob, nh_prob)
+            V[mb_start:mb_end, :] = buffers[2]
 
             # Monitor the updates
             if it % n_it_per_epoch == 0 and it != 0:
@@ -233,13 +467,14 @@ class RestrictedBoltzmannMachine():
             return errors
 
 
-    def get_h_given_v(self, v, directed=False, direction="up"):
+    def get_h_given_v(self, v, directed=False, direction="up", u=None):
         """Compute probabilities p(h|v) and activations h ~ p(h|v)
 
         Args:
             v (np.ndarray): Units of the visible layer
             directed (bool): Whether to use weight_v_to_h or weight_vh
             direction (str): One of "up" or "down"
+            u (np.ndarray): Optional uniform random numbers for the sampling
 
         Returns:
             Returns:
@@ -248,27 +483,57 @@ class RestrictedBoltzmannMachine():
                                   (size mini-batch, size hidden layer)
         """
         if not directed:
-            h_prob = self._sigmoid(self.bias_h + v@self.weight_vh)
+            weight = self.weight_vh
         else:
             if direction == "up":
-                h_prob = self._sigmoid(self.bias_h + v@self.weight_v_to_h)
+                weight = self.weight_v_to_h
             elif direction == "down":
-                h_prob = self._sigmoid(self.bias_h + v@self.weight_h_to_v)
+                weight = self.weight_h_to_v
             else:
                 raise ValueError("Input argument <directed> has to be either 'up' or 'down'.")
 
-        h_state = self._sample_binary(h_prob)
+        support = self._support(v, weight, self.bias_h)
+        h_prob, h_state = self._sigmoid_sample(support, u=u)
 
         return h_prob, h_state
 
 
-    def get_v_given_h(self, h, directed=False, direction="up"):
+    def get_h_prob_given_v(self, v, chunk_size=4096, out=None):
+        """Compute p(h=1|v) for a complete data set with the recognition
+        weights, without sampling the hidden states
+
+        The data is propagated in chunks that are written straight into the
+        output array, so no intermediate of the full data size is created.
+
+        Args:
+            v (np.ndarray): Units of the visible layer shaped (size of data set,
+                            size of visible layer)
+            chunk_size (int): Number of data points propagated at once
+            out (np.ndarray): Optional output array, which may be a view
+
+        Returns:
+            h_prob (np.ndarray): p(h=1|v) (size of data set, size hidden layer)
+        """
+        h_prob = out if out is not None else np.empty(
+                (v.shape[0], self.ndim_hidden), dtype=self.weight_v_to_h.dtype)
+
+        for start in range(0, v.shape[0], chunk_size):
+            chunk = h_prob[start:start+chunk_size]
+            self._support(v[start:start+chunk_size], self.weight_v_to_h,
+                    self.bias_h, out=chunk)
+            _sigmoid_kernel(chunk)
+
+        return h_prob
+
+
+    def get_v_given_h(self, h, directed=False, direction="up", u=None):
         """Compute probabilities p(v|h) and activations v ~ p(v|h)
 
         Args:
             h: Units of the hidden layer
             directed (bool): Whether to use weight_v_to_h or weight_vh
             direction (str): One of "up" or "down"
+            u (np.ndarray): Optional uniform random numbers for the sampling
 
         Returns:
            v_prob (np.ndarray): p(v=1|h) (size mini-batch, size hidden layer)
@@ -277,42 +542,52 @@ class RestrictedBoltzmannMachine():
         """
         if self.is_top:
             # Separate H_batch into the data support and labels support
-            support = self.bias_v + h@self.weight_vh.T
+            support = self._support(h, self.weight_vh.T, self.bias_v)
             support_data = support[:, :-self.n_labels]
             support_labels = support[:, -self.n_labels:]
 
+            # Write both parts straight into a normal visible layer
+            v_prob = np.empty(support.shape, dtype=support.dtype)
+            v_state = np.empty(support.shape, dtype=support.dtype)
+
+            # The first label column of u drives the categorical sampling
+            u_data, u_labels = (None, None) if u is None else \
+                    (u[:, :-self.n_labels], u[:, -self.n_labels])
+
             # Activate and sample for the data
-            v_prob_data = self._sigmoid(support_data)
-            v_state_data = self._sample_binary(v_prob_data)
+            self._sigmoid_sample(support_data, prob=v_prob[:, :-self.n_labels],
+                    state=v_state[:, :-self.n_labels], u=u_data)
 
             # Activate and sample for the labels
-            v_prob_labels = self._softmax(support_labels)
-            v_state_labels = self._sample_categorical(v_prob_labels)
-
-            # Concatenate into a normal visible layer
-            v_prob = np.hstack((v_prob_data, v_prob_labels))
-            v_state = np.hstack((v_state_data, v_state_labels))
+            v_prob[:, -self.n_labels:] = self._softmax(support_labels)
+            v_state[:, -self.n_labels:] = self._sample_categorical(
+                    v_prob[:, -self.n_labels:], u=u_labels)
 
         else:
             if not directed:
-                v_prob = self._sigmoid(self.bias_v + h@self.weight_vh.T)
+                weight = self.weight_vh.T
             else:
                 if direction == "up":
-                    v_prob = self._sigmoid(self.bias_v + h@self.weight_v_to_h)
+                    weight = self.weight_v_to_h
                 elif direction == "down":
-                    v_prob = self._sigmoid(self.bias_v + h@self.weight_h_to_v)
+                    weight = self.weight_h_to_v
                 else:
                     raise ValueError("Input argument <directed> has to be either 'up' or 'down'.")
 
-            v_state = self._sample_binary(v_prob)
+            support = self._support(h, weight, self.bias_v)
+            v_prob, v_state = self._sigmoid_sample(support, u=u)
 
         return v_prob, v_state
 
 
     def untwine_weights(self):
-        """Decouple weight matrix"""
-        self.weight_v_to_h = np.copy(self.weight_vh)
-        self.weight_h_to_v = np.copy(self.weight_vh.T)
+        """Decouple weight matrix
+
+        The recognition weights take over the storage of weight_vh, so only
+        the generative weights are copied.
+        """
+        self.weight_v_to_h = self.weight_vh
+        self.weight_h_to_v = np.ascontiguousarray(self.weight_vh.T)
         self.weight_vh = None
 
 
@@ -329,18 +604,13 @@ class RestrictedBoltzmannMachine():
         Note: You could also add weight decay and momentum for weight updates.
         """
 
-        self.d_weight_vh = (1 - self.momentum) * self.learning_rate * \
-                ((v0.T@h0 - v1.T@h1) - self.decay * self.weight_vh) + \
-                self.momentum * self.d_weight_vh
-        self.weight_vh += self.d_weight_vh
-
-        self.d_bias_v = (1 - self.momentum) * self.learning_rate * \
-                np.mean(v0 - v1, axis=0) + self.d_bias_v * self.momentum
-        self.bias_v += self.d_bias_v
-
-        self.d_bias_h = (1 - self.momentum) * self.learning_rate * \
-                np.mean(h0 - h1, axis=0) + self.d_bias_h * self.momentum
-        self.bias_h += self.d_bias_h
+        # Accumulate the momentum updates in place in the persistent arrays
+        _momentum_step(self.weight_vh, self.d_weight_vh, v0.T@h0 - v1.T@h1,
+                self.learning_rate, self.momentum, self.decay)
+        _momentum_step(self.bias_v, self.d_bias_v,
+                np.mean(v0 - v1, axis=0), self.learning_rate, self.momentum, 0.)
+        _momentum_step(self.bias_h, self.d_bias_h,
+                np.mean(h0 - h1, axis=0), self.learning_rate, self.momentum, 0.)
 
 
     def update_generate_params(self, y, x, y_hat):
@@ -92,7 +92,7 @@ if __name__ == "__main__":
         if GENERATE:
             # Generate prototyical digits
             for digit in range(10):
-                digit_1hot = np.zeros(shape=(1, 10))
+                digit_1hot = np.zeros(shape=(1, 10), dtype=np.float32)
                 digit_1hot[0, digit] = 1
                 # Initialize based on a random training input
                 # (In this case we always use the first training image)
@@ -114,7 +114,7 @@ if __name__ == "__main__":
         if GENERATE:
             # Generate prototyical digits
             for digit in range(10):
-                digit_1hot = np.zeros(shape=(1, 10))
+                digit_1hot = np.zeros(shape=(1, 10), dtype=np.float32)
                 digit_1hot[0, digit] = 1
                 # Initialize based on a random training input
                 # (In this case we always use the first training image)
@@ -11,18 +11,21 @@ Note: Part of this code was provided by the course coordinators.
 __author__ = "Anton Anderzén, Stella Katsarou, Bas Straathof"
 
 
+import functools
 import struct
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
+from matplotlib.figure import Figure
 
 
 
-def load_idxfile(filename):
+def load_idxfile(filename, n_items=None):
     """Load idx file format.
 
     Args:
         filename (str)
+        n_items (int): Only read the first n_items entries, all if None
 
     Returns:
         data (np.ndarray)
@@ -34,8 +37,10 @@ def load_idxfile(filename):
            raise Exception('Invalid idx file: unexpected magic number!')
         dtype, ndim = ord(_file.read(1)), ord(_file.read(1))
         shape = [struct.unpack(">I", _file.read(4))[0] for _ in range(ndim)]
+        if n_items is not None:
+            shape[0] = min(n_items, shape[0])
         data = np.fromfile(_file, dtype=np.dtype(np.uint8).newbyteorder(
-            '>')).reshape(shape)
+            '>'), count=int(np.prod(shape))).reshape(shape)
 
     return data
 
@@ -54,26 +59,26 @@ def read_mnist(dim=[28,28], n_train=60000, n_test=1000):
         test_imgs (np.ndarray): The test images
         test_lbls_1hot (np.ndarray): One-hot-encoded test labels
 
-    Note: Images are normalized to be in range [0,1]
+    Note: Images are normalized to be in range [0,1] and stored as float32
     """
-    train_imgs = load_idxfile("../data/train-images-idx3-ubyte")
-    train_imgs = train_imgs / 255.
+    # Only the requested images are read and normalized
+    train_imgs = load_idxfile("../data/train-images-idx3-ubyte", n_train)
+    train_imgs = np.divide(train_imgs, 255., dtype=np.float32)
     train_imgs = train_imgs.reshape(-1,dim[0]*dim[1])
 
-    train_lbls = load_idxfile("../data/train-labels-idx1-ubyte")
+    train_lbls = load_idxfile("../data/train-labels-idx1-ubyte", n_train)
     train_lbls_1hot = np.zeros((len(train_lbls),10),dtype=np.float32)
     train_lbls_1hot[range(len(train_lbls)),train_lbls] = 1.
 
-    test_imgs = load_idxfile("../data/t10k-images-idx3-ubyte")
-    test_imgs = test_imgs / 255.
+    test_imgs = load_idxfile("../data/t10k-images-idx3-ubyte", n_test)
+    test_imgs = np.divide(test_imgs, 255., dtype=np.float32)
     test_imgs = test_imgs.reshape(-1,dim[0]*dim[1])
 
-    test_lbls = load_idxfile("../data/t10k-labels-idx1-ubyte")
+    test_lbls = load_idxfile("../data/t10k-labels-idx1-ubyte", n_test)
     test_lbls_1hot = np.zeros((len(test_lbls),10),dtype=np.float32)
     test_lbls_1hot[range(len(test_lbls)),test_lbls] = 1.
 
-    return train_imgs[:n_train], train_lbls_1hot[:n_train], test_imgs[:n_test], \
-            test_lbls_1hot[:n_test]
+    return train_imgs, train_lbls_1hot, test_imgs, test_lbls_1hot
 
 
 def viz_rf(weights, it, grid):
@@ -97,18 +102,50 @@ def viz_rf(weights, it, grid):
     plt.close('all')
 
 
-def stitch_video(fig, imgs):
-    """Stitches a list of images and returns an animation object
+@functools.lru_cache(maxsize=None)
+def _video_canvas(height, width):
+    """Builds the figure that videos are rendered in, once per image size
+
+    The figure is not registered with pyplot, so plt.close('all') elsewhere
+    does not close it.
 
     Args:
-        fig (matplotlib.figure.Figure): Plot
-        imgs (list): List of images
+        height (int): Height of the images
+        width (int): Width of the images
 
     Returns:
-        (matplotlib.animation.ArtistAnimation): The stitched video
+        fig (matplotlib.figure.Figure): The figure
+        img (matplotlib.image.AxesImage): The image whose data is swapped
     """
-    return animation.ArtistAnimation(fig, imgs, interval=100, blit=True,
-            repeat=False)
+    fig = Figure(figsize=(3, 3))
+    fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_xticks([]); ax.set_yticks([])
+    img = ax.imshow(np.zeros((height, width)), cmap="bwr", vmin=0, vmax=1,
+            animated=True, interpolation=None)
+
+    return fig, img
+
+
+def save_video(frames, fname):
+    """Renders a stack of images to a video file
+
+    A single image is drawn and its data swapped for every frame, instead of
+    creating one artist per frame. The figure is reused across calls.
+
+    Args:
+        frames (np.ndarray): Images shaped (number of frames, height, width)
+        fname (str): File name for saving
+    """
+    fig, img = _video_canvas(*frames.shape[1:])
+    img.set_data(frames[0])
+
+    def update(frame):
+        img.set_data(frame)
+        return img,
+
+    animation.FuncAnimation(fig, update, frames=frames, interval=100,
+            blit=True, repeat=False).save(fname)
 
 
 def create_histogram(x, bins, title="", xlabel="", ylabel="",